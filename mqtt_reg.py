@@ -5,6 +5,8 @@ import ujson
 import uio
 import machine
 import random
+import time
+import heapq
 import btree
 import struct
 
@@ -43,6 +45,16 @@ class ServerReadOnlyRegister(ServerRegister):
         raise Exception("Cannot set value of read-only register")
 
 __default_db = None
+_default_db_pagesize = 512
+_default_db_cachesize = 512
+
+def configure_default_db(pagesize=512, cachesize=512):
+    # btree keeps at least five pages cached, so with 4096 byte pages the cache takes 20 KB of heap or more
+    global _default_db_pagesize, _default_db_cachesize
+    if __default_db is not None:
+        raise Exception("Default register database is already open")
+    _default_db_pagesize = pagesize
+    _default_db_cachesize = cachesize
 
 def __get_default_db():
     global __default_db
@@ -52,36 +64,116 @@ def __get_default_db():
         except OSError:
             db_file = open("/regs.btree", "w+b")
 
-        __default_db = btree.open(db_file, pagesize=512, cachesize=512)
+        __default_db = btree.open(db_file, pagesize=_default_db_pagesize, cachesize=_default_db_cachesize)
     return __default_db
 
+_dirty_dbs = []
+
+def _mark_dirty(db):
+    if db not in _dirty_dbs:
+        _dirty_dbs.append(db)
+
+def flush_dbs():
+    while _dirty_dbs:
+        # taken off the list first so that a write made during the flush marks it dirty again
+        db = _dirty_dbs.pop()
+        try:
+            db.flush()
+        except Exception:
+            _mark_dirty(db)
+            raise
+
 class PersistentServerRegister(ServerRegister):
 
     def __init__(self, name, meta, default, db = None):
         super().__init__(name, meta)
         self.db = db or __get_default_db()
+        self.init_value(default)
 
+    def init_value(self, default):
         if self.name not in self.db:
             self.set_value(default)
+            # registers are usually created before any Registry runs its flush loop
+            self.db.flush()
 
     def get_value(self):
         return self.from_bytes(self.db.get(self.name))
 
     def set_value(self, value):
         self.db[self.name] = self.to_bytes(value)
-        self.db.flush()
+        _mark_dirty(self.db)
+
+
+class _BooleanBitmap:
+
+    NAMES_KEY = b'__bool_names__'
+    BITS_KEY = b'__bools__'
+
+    def __init__(self, db):
+        self.db = db
+        names = db.get(self.NAMES_KEY)
+        self.names = names.decode().split('\n') if names else []
+        self.bits = bytearray(db.get(self.BITS_KEY) or b'')
+        # the bits may lag behind the names if the last flush did not complete
+        missing = (len(self.names) + 7) // 8 - len(self.bits)
+        if missing > 0:
+            self.bits.extend(bytearray(missing))
+
+    def add(self, name):
+        if name in self.names:
+            return self.names.index(name), False
+
+        self.names.append(name)
+        self.db[self.NAMES_KEY] = '\n'.join(self.names)
+        index = len(self.names) - 1
+        if len(self.bits) <= index >> 3:
+            self.bits.append(0)
+        return index, True
 
+    def get(self, index):
+        return (self.bits[index >> 3] & (1 << (index & 7))) != 0
+
+    def set(self, index, value):
+        if value:
+            self.bits[index >> 3] |= 1 << (index & 7)
+        else:
+            self.bits[index >> 3] &= ~(1 << (index & 7))
+        self.db[self.BITS_KEY] = bytes(self.bits)
+        _mark_dirty(self.db)
+
+_boolean_bitmaps = []
+
+def _get_boolean_bitmap(db):
+    for bitmap in _boolean_bitmaps:
+        if bitmap.db is db:
+            return bitmap
+    bitmap = _BooleanBitmap(db)
+    _boolean_bitmaps.append(bitmap)
+    return bitmap
 
 class BooleanPersistentServerRegister(PersistentServerRegister):
 
     def __init__(self, name, meta, default=False, db = None):
         super().__init__(name, meta, default, db)
 
-    def to_bytes(self, value):
-        return b'\1' if value == True else b'\0'
+    def init_value(self, default):
+        # all booleans of a database share one bitmap entry, so toggling any of them rewrites a single key
+        self.bitmap = _get_boolean_bitmap(self.db)
+        self.index, new = self.bitmap.add(self.name)
 
-    def from_bytes(self, value):
-        return True if value == b'\1' else False
+        if new:
+            if self.name in self.db:
+                # migrate a value stored under its own key by earlier versions
+                default = self.db[self.name] == b'\1'
+                del self.db[self.name]
+            self.set_value(default)
+            self.db.flush()
+
+    def get_value(self):
+        return self.bitmap.get(self.index)
+
+    def set_value(self, value):
+        self.bitmap.set(self.index, value == True)
 
 class FloatPersistentServerRegister(PersistentServerRegister):
 
@@ -94,16 +186,23 @@ class FloatPersistentServerRegister(PersistentServerRegister):
     def from_bytes(self, value):
         return struct.unpack('f', value)[0]
 
+# ustruct has no Struct, so on device the methods above stay as they are
+if hasattr(struct, 'Struct'):
+    _FLOAT = struct.Struct('f')
+    FloatPersistentServerRegister.to_bytes = lambda self, value: _FLOAT.pack(value)
+    FloatPersistentServerRegister.from_bytes = lambda self, value: _FLOAT.unpack(value)[0]
+
 class ServerListHandler:
 
-    def __init__(self, registry, registers=[]):
+    def __init__(self, registry, registers=None):
         self.registers = {}
-        for register in registers:
+        for register in registers or ():
             self.registers[register.get_name()] = register
             register.registry = registry
+        self.names = tuple(self.registers.keys())
 
     def get_names(self):
-        return list(self.registers.keys())
+        return self.names
 
     def get_meta(self, name):
         return self.registers[name].get_meta()
@@ -130,35 +229,96 @@ class ClientRegister:
 
 class ClientListHandler:
 
-    def __init__(self, registers=[]):
+    def __init__(self, registers=None):
         self.registers = {}
-        for register in registers:
+        for register in registers or ():
             name = register.get_name()
             self.registers[name] = register
+        self.names = tuple(self.registers.keys())
 
     def get_names(self):
-        return list(self.registers.keys())
+        return self.names
 
     def set_value(self, name, value):
         self.registers[name].set_value(value)
 
+def _decode_value(message):
+    # register values are mostly booleans and numbers, parse those without going through ujson
+    if len(message) == 0 or message == b'null':
+        return None
+    if message == b'true':
+        return True
+    if message == b'false':
+        return False
+    if message[0] not in (0x7b, 0x5b, 0x22):  # {, [ or "
+        try:
+            if b'.' in message or b'e' in message or b'E' in message:
+                return float(message)
+            return int(message)
+        except ValueError:
+            pass
+    return ujson.loads(message)
+
+class _JsonBuffer(uio.IOBase):
+
+    def __init__(self, size=256):
+        self.buf = bytearray(size)
+        self.pos = 0
+
+    def write(self, data):
+        end = self.pos + len(data)
+        if end > len(self.buf):
+            self.buf.extend(bytearray(end - len(self.buf)))
+        self.buf[self.pos:end] = data
+        self.pos = end
+        return len(data)
+
+    def dump(self, val):
+        # the returned view is only valid until the next dump
+        self.pos = 0
+        ujson.dump(val, self)
+        return memoryview(self.buf)[:self.pos]
+
 class Registry:
 
     advertise_in_progress = False
 
-    def __init__(self, wifi_ssid, wifi_password, mqtt_broker, server=[], client=[], online_cb=None, debug=False):
+    def __init__(self, wifi_ssid, wifi_password, mqtt_broker, server=None, client=None, online_cb=None, debug=False):
         self.debug = debug
 
         self.server_handler = ServerListHandler(
-            self, server) if type(server) is list else server
+            self, server) if server is None or isinstance(server, (list, tuple)) else server
         self.client_handler = ClientListHandler(
-            client) if type(client) is list else client
+            client) if client is None or isinstance(client, (list, tuple)) else client
+
+        self.server_registers = self.server_handler.registers if isinstance(
+            self.server_handler, ServerListHandler) else None
 
         self.server_names = self.server_handler.get_names()
         self.client_names = self.client_handler.get_names()
 
-        self.client_timeouts = {}
-        self.publish_in_progress = {}
+        self.is_topics = {}
+        self.get_topics = {}
+        self.topic_dispatch = {}
+        if len(self.server_names) > 0:
+            self.topic_dispatch['register/advertise!'] = (self.__handle_advertise, None)
+        for name in self.server_names:
+            self.is_topics[name] = 'register/'+name+'/is'
+            self.topic_dispatch['register/'+name+'/get'] = (self.__handle_get, name)
+            self.topic_dispatch['register/'+name+'/set'] = (self.__handle_set, name)
+        for name in self.client_names:
+            self.get_topics[name] = 'register/'+name+'/get'
+            self.topic_dispatch['register/'+name+'/is'] = (self.__handle_is, name)
+
+        self.client_deadlines = {}
+        self.client_polled = {}
+        self.client_timeout_heap = []
+        self.client_timeout_task = None
+        self.clock_ms = 0
+        self.clock_ticks = time.ticks_ms()
+        self.publish_queue = []
+        # may be set from the main thread while the event loop runs in the background one
+        self.publish_event = uasyncio.ThreadSafeFlag()
 
         mqtt_config = mqtt_as.config.copy()
         mqtt_config['ssid'] = wifi_ssid
@@ -173,43 +333,53 @@ class Registry:
 
         self.online_cb(False)
 
-    async def __publish_json(self, topic, val):
-        message = uio.BytesIO()
-
-        if val != None:
-            ujson.dump(val, message)
-
-        message = message.getvalue()
-
+    async def __publish_json(self, topic, val, buffer=None):
+        if val is None:
+            message = b''
+        elif val is True:
+            message = b'true'
+        elif val is False:
+            message = b'false'
+        elif isinstance(val, (int, float)):
+            message = str(val).encode()
+        elif buffer is not None:
+            message = buffer.dump(val)
+        else:
+            message = ujson.dumps(val).encode()
         await self.mqtt_client.publish(topic, message, qos=0)
 
-    def publish_register_value(self, name):
+    async def __publish_loop(self):
+        server_registers = self.server_registers
+        json_buffer = _JsonBuffer()
 
-        async def do_async():
+        while True:
+            await self.publish_event.wait()
 
-            value = self.server_handler.get_value(name)
+            while self.publish_queue:
+                name = self.publish_queue.pop(0)
 
-            if self.debug:
-                print('Publishing register value:', name, value)
+                try:
+                    if server_registers is None:
+                        value = self.server_handler.get_value(name)
+                    else:
+                        value = server_registers[name].get_value()
 
-            try:
-                await self.__publish_json('register/'+name+'/is', value)
-                if self.debug:
-                    print('OK, published register value:', name, value)
+                    if self.debug:
+                        print('Publishing register value:', name, value)
 
-            except Exception as e:
-                print('Error publishing register value: ', e)
-            finally:
-                pubs = self.publish_in_progress[name]
-                if pubs > 0:
-                    self.publish_in_progress[name] =  pubs - 1
+                    await self.__publish_json(self.is_topics[name], value, json_buffer)
+                    if self.debug:
+                        print('OK, published register value:', name, value)
 
-        if name not in self.publish_in_progress:
-            self.publish_in_progress[name] = 0
+                except Exception as e:
+                    print('Error publishing register value: ', e)
 
-        if self.publish_in_progress[name] < 2:
-            self.publish_in_progress[name] = self.publish_in_progress[name] + 1
-            uasyncio.create_task(do_async())
+    def publish_register_value(self, name):
+
+        # a queued name is published with the value current at that time, so queueing it again is redundant
+        if name not in self.publish_queue:
+            self.publish_queue.append(name)
+            self.publish_event.set()
         else:
             if self.debug:
                 print('Publish in progress, skipping')
@@ -224,9 +394,10 @@ class Registry:
                 if self.debug:
                     print('Advertising registers')
 
-                for name in self.server_names:
-                    meta = self.server_handler.get_meta(name)
-                    await self.__publish_json('register/'+name+'/advertise', meta)
+                await uasyncio.gather(*[
+                    self.__publish_json('register/'+name+'/advertise', self.server_handler.get_meta(name))
+                    for name in self.server_names
+                ])
 
             finally:
                 self.advertise_in_progress = False
@@ -234,42 +405,119 @@ class Registry:
         if not self.advertise_in_progress:
             uasyncio.create_task(do_async())
 
-    def reset_client_timeout(self, name, first=False):
+    def __now_ms(self):
+        # monotonic milliseconds, unlike ticks_ms() it does not wrap and so can order the heap
+        ticks = time.ticks_ms()
+        self.clock_ms += time.ticks_diff(ticks, self.clock_ticks)
+        self.clock_ticks = ticks
+        return self.clock_ms
 
-        async def do_async(first):
-            while True:
-                try:
-                    if not first:
-                        await uasyncio.sleep_ms(random.randint(8000, 12000))
+    def __schedule_client_timeout(self, name, deadline):
+        self.client_deadlines[name] = deadline
+        heapq.heappush(self.client_timeout_heap, (deadline, name))
 
-                    first = False
+    async def __client_timeout_loop(self):
+        heap = self.client_timeout_heap
 
-                    if self.debug:
-                        print('Forcing get for client register', name)
+        while heap:
+            deadline, name = heap[0]
+            now = self.__now_ms()
+
+            if deadline > now:
+                await uasyncio.sleep_ms(deadline - now)
+                continue
+
+            heapq.heappop(heap)
 
-                    await self.mqtt_client.publish('register/'+name+'/get', '', qos=0)
-                    await uasyncio.sleep_ms(10000)
+            # reset_client_timeout only moves the deadline, the entry is re-armed here once it falls due
+            rearmed = self.client_deadlines[name]
+            if rearmed > deadline:
+                heapq.heappush(heap, (rearmed, name))
+                continue
+
+            try:
+                if self.client_polled[name]:
 
                     if self.debug:
                         print('Timeout for client register', name)
 
+                    self.client_polled[name] = False
+                    self.__schedule_client_timeout(name, now + random.randint(8000, 12000))
                     self.client_handler.set_value(name, None)
 
-                except Exception as e:
+                else:
+
                     if self.debug:
-                        print('Error in reset_client_timeout:', e)
+                        print('Forcing get for client register', name)
+
+                    self.client_polled[name] = True
+                    self.__schedule_client_timeout(name, now + 10000)
+                    await self.mqtt_client.publish(self.get_topics[name], '', qos=0)
+
+            except Exception as e:
+                if self.debug:
+                    print('Error in client timeout loop:', e)
+
+    def reset_client_timeout(self, name):
 
-        if name in self.client_timeouts:
-            self.client_timeouts[name].cancel()
+        self.client_polled[name] = False
+        self.client_deadlines[name] = self.__now_ms() + random.randint(8000, 12000)
 
-        self.client_timeouts[name] = uasyncio.create_task(do_async(first))
+    def arm_client_timeouts(self):
+
+        if self.client_timeout_task is not None:
+            self.client_timeout_task.cancel()
+
+        self.client_timeout_heap.clear()
+        now = self.__now_ms()
+        for name in self.client_names:
+            self.client_polled[name] = False
+            self.__schedule_client_timeout(name, now)
+
+        self.client_timeout_task = uasyncio.create_task(self.__client_timeout_loop())
+
+    def __handle_advertise(self, name, message):
+        self.advertise_registers()
+
+    def __handle_get(self, name, message):
+        if self.debug:
+            print('Get', name)
+        self.publish_register_value(name)
+
+    def __handle_set(self, name, message):
+        value = _decode_value(message)
+        if self.debug:
+            print('Set', name, value)
+        if self.server_registers is None:
+            self.server_handler.set_value(name, value)
+        else:
+            self.server_registers[name].set_value(value)
+        self.publish_register_value(name)
+
+    def __handle_is(self, name, message):
+        value = _decode_value(message)
+        if self.debug:
+            print(name, 'is', value)
+        self.reset_client_timeout(name)
+        self.client_handler.set_value(name, value)
+
+    async def __flush_loop(self):
+        while True:
+            await uasyncio.sleep_ms(500)
+            try:
+                flush_dbs()
+            except Exception as e:
+                print('Error flushing register database:', e)
 
     async def run_async(self):
 
+        uasyncio.create_task(self.__flush_loop())
+
         self.online_cb(True)
         await uasyncio.sleep_ms(200)
         self.online_cb(False)
 
+        delay = 1000
         while True:
             try:
                 await self.mqtt_client.connect()
@@ -278,8 +526,16 @@ class Registry:
                 if self.debug:
                     print('Error connecting to MQTT broker:', e)
 
-                await uasyncio.sleep_ms(5000)
-                if str(e) == 'Wifi Internal Error':
+                # back off exponentially with jitter so devices do not reconnect in lockstep
+                await uasyncio.sleep_ms(delay + random.randint(0, delay))
+                delay = min(delay * 2, 30000)
+
+                # the ESP32 port raises a plain OSError carrying this message, it only recovers on reset
+                if isinstance(e, OSError) and e.args and e.args[0] == 'Wifi Internal Error':
+                    try:
+                        flush_dbs()
+                    except Exception as e:
+                        print('Error flushing register database:', e)
                     machine.reset()
 
         async def up_event_loop():
@@ -295,17 +551,10 @@ class Registry:
 
                         await self.mqtt_client.subscribe(topic, qos=0)
 
-                    if len(self.server_names) > 0:
-                        await subscribe('register/advertise!')
-
-                    for name in self.server_names:
-                        await subscribe('register/'+name+'/get')
-                        await subscribe('register/'+name+'/set')
-
-                    for name in self.client_names:
-                        await subscribe('register/'+name+'/is')
-                        self.reset_client_timeout(name, first=True)
+                    # mqtt_as waits for each SUBACK outside its lock, so concurrent subscribes pipeline
+                    await uasyncio.gather(*[subscribe(topic) for topic in self.topic_dispatch])
 
+                    self.arm_client_timeouts()
                     self.advertise_registers()
 
                 except Exception as e:
@@ -327,46 +576,17 @@ class Registry:
 
         uasyncio.create_task(down_event_loop())
 
+        uasyncio.create_task(self.__publish_loop())
+
         async def read_messages():
+            topic_dispatch = self.topic_dispatch
+
             async for topic, message, retained in self.mqtt_client.queue:
                 if not retained:
                     try:
-                        topic = topic.decode()
-
-                        if topic == 'register/advertise!':
-                            self.advertise_registers()
-
-                        else:
-
-                            if topic.startswith('register/'):
-
-                                if topic.endswith('/get'):
-                                    name = topic[9:-4]
-                                    if self.debug:
-                                        print('Get', name)
-                                    self.publish_register_value(name)
-
-                                else:
-                                    if topic.endswith('/set'):
-                                        name = topic[9:-4]
-                                        value = None if len(message) == 0 else ujson.load(
-                                            uio.BytesIO(message.decode()))
-                                        if self.debug:
-                                            print('Set', name, value)
-                                        self.server_handler.set_value(
-                                            name, value)
-                                        self.publish_register_value(name)
-
-                                    else:
-                                        if topic.endswith('/is'):
-                                            name = topic[9:-3]
-                                            value = None if len(message) == 0 else ujson.load(
-                                                uio.BytesIO(message.decode()))
-                                            if self.debug:
-                                                print(name, 'is', value)
-                                            self.reset_client_timeout(name)
-                                            self.client_handler.set_value(
-                                                name, value)
+                        handler = topic_dispatch.get(topic.decode())
+                        if handler is not None:
+                            handler[0](handler[1], message)
 
                     except Exception as e:
                         if self.debug: